@@ -1,18 +1,231 @@
+import asyncio
 import os
+import sys
+import threading
+import time
 import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # Disable connectivity check on startup - must be before any paddle imports
 os.environ["PADDLE_PDX_DISABLE_MODEL_SOURCE_CHECK"] = "True"
 
+import cv2
+import fitz  # PyMuPDF
 import uvicorn
 from fastapi import FastAPI, UploadFile, File, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
+import orjson
 from paddleocr import PaddleOCR
 import numpy as np
 import io
 from PIL import Image
 
-app = FastAPI(title="PaddleOCR Bridge API")
+# orjson serializes numpy scalars/arrays natively (OPT_SERIALIZE_NUMPY),
+# so results can carry them straight through to the encoder.
+app = FastAPI(title="PaddleOCR Bridge API", default_response_class=ORJSONResponse)
+
+# Cap concurrent inference calls - multiple interleaved Paddle predictor
+# sessions fight over the same CUDA context (or thrash CPU caches).
+OCR_SEM = asyncio.Semaphore(int(os.environ.get("OCR_MAX_CONCURRENCY", "1")))
+
+# Paddle releases the GIL during C++ inference, so running predict on a
+# worker thread keeps the event loop free for uploads and responses.
+POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ocr")
+
+# Per-thread scratch ndarray reused across requests as the dst= of
+# OpenCV calls, cutting allocator churn for same-sized images.
+_BUFS = threading.local()
+
+
+def _get_buf(shape):
+    buf = getattr(_BUFS, "buf", None)
+    # getrefcount > 3 means a prior request (e.g. an item still sitting in
+    # the batch queue) holds the buffer, so allocate a fresh one instead
+    # of scribbling over it. 3 = _BUFS attr + local + getrefcount arg.
+    if buf is None or buf.shape != shape or sys.getrefcount(buf) > 3:
+        buf = np.empty(shape, dtype=np.uint8)
+        _BUFS.buf = buf
+    return buf
+
+
+def _format_page(item, fallback_index):
+    """Shape one OCRResult into the page structure the frontend consumes."""
+    # OCRResult is dict-like: read it directly. The .json property runs a
+    # deepcopy + reformat of the whole result, and its fields arrive as
+    # plain Python already - here scores/polys are still numpy, so the
+    # bulk conversions below actually replace per-line work.
+    if hasattr(item, 'get') and 'rec_texts' in item:
+        res = item
+    else:
+        # Older result shapes only expose the data via .json
+        formatted = item.json
+        res = formatted.get('res', formatted)
+
+    rec_texts = res.get('rec_texts', [])
+    rec_scores = res.get('rec_scores', [])
+    dt_polys = res.get('dt_polys', [])
+    page_index = res.get('page_index', None)
+    page_num = (page_index if page_index is not None else fallback_index) + 1
+
+    # One C-level pass per field for the whole page
+    texts = [str(t) for t in rec_texts]
+    scores = (
+        np.asarray(rec_scores, dtype=np.float64).tolist() if len(rec_scores) else []
+    )
+    try:
+        polys = np.asarray(dt_polys).tolist() if len(dt_polys) else []
+    except ValueError:
+        # Ragged polygons (mixed point counts) can't be stacked
+        polys = [p.tolist() if hasattr(p, 'tolist') else p for p in dt_polys]
+    if len(scores) < len(texts):
+        scores += [0.0] * (len(texts) - len(scores))
+    if len(polys) < len(texts):
+        polys += [[]] * (len(texts) - len(polys))
+
+    return {
+        "page_number": page_num,
+        "text": "\n".join(texts),
+        "line_count": len(texts),
+        "results": [
+            {"text": t, "confidence": s, "box": b, "page": page_num}
+            for t, s, b in zip(texts, scores, polys)
+        ],
+    }
+
+
+def _downscale(img_array):
+    """Clamp the longest side to OCR_MAX_SIDE (no-op for small images)."""
+    h, w = img_array.shape[:2]
+    scale = OCR_MAX_SIDE / max(h, w)
+    if scale < 1.0:
+        img_array = cv2.resize(
+            img_array,
+            (int(w * scale), int(h * scale)),
+            interpolation=cv2.INTER_AREA,
+        )
+    return img_array
+
+
+def _render_page(page):
+    """Rasterize one PDF page to a clamped BGR ndarray."""
+    pix = page.get_pixmap(dpi=OCR_PDF_DPI, colorspace=fitz.csRGB)
+    arr = np.frombuffer(pix.samples, np.uint8).reshape(pix.height, pix.width, 3)
+    return _downscale(cv2.cvtColor(arr, cv2.COLOR_RGB2BGR))
+
+
+def _render_pdf(contents):
+    """Render PDF pages in-memory to BGR ndarrays, no temp file."""
+    with fitz.open(stream=contents, filetype="pdf") as doc:
+        return [_render_page(page) for page in doc]
+
+
+async def _stream_pages(contents):
+    """Render, OCR and emit PDF pages incrementally as NDJSON lines.
+
+    At most OCR_BATCH_SIZE rendered pages are in flight at once, so
+    memory stays bounded on huge documents while the batcher can still
+    coalesce the look-ahead pages into batched predict calls.
+    """
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    try:
+        with fitz.open(stream=contents, filetype="pdf") as doc:
+            for i in range(doc.page_count):
+                img = await loop.run_in_executor(POOL, _render_page, doc[i])
+                fut = loop.create_future()
+                await BATCH_QUEUE.put((img, fut))
+                pending.append((i, fut))
+                if len(pending) >= OCR_BATCH_SIZE:
+                    index, fut = pending.popleft()
+                    page = _format_page(await fut, index)
+                    yield orjson.dumps(page, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+            while pending:
+                index, fut = pending.popleft()
+                page = _format_page(await fut, index)
+                yield orjson.dumps(page, option=orjson.OPT_SERIALIZE_NUMPY) + b"\n"
+    except OCRBusyError as e:
+        yield orjson.dumps({"error": f"OCR engine overloaded: {e}"}) + b"\n"
+    except Exception as e:
+        print(f"OCR Error (stream): {e}")
+        traceback.print_exc()
+        yield orjson.dumps({"error": str(e)}) + b"\n"
+
+
+# Transient resource errors (GPU OOM, CUDA hiccups) are worth a couple
+# of backed-off retries before telling the client to slow down.
+_TRANSIENT_MARKERS = ("out of memory", "resourceexhausted", "cuda error", "rate limit")
+
+
+class OCRBusyError(Exception):
+    """Inference kept failing with a transient resource error."""
+
+
+def _predict_with_retry(input_data, attempts=3):
+    delay = 0.5
+    for attempt in range(attempts):
+        try:
+            return ocr.predict(input_data)
+        except Exception as e:
+            msg = str(e).lower()
+            if not any(m in msg for m in _TRANSIENT_MARKERS):
+                raise
+            if attempt == attempts - 1:
+                raise OCRBusyError(str(e)) from e
+            time.sleep(min(delay, 4.0))
+            delay *= 2
+
+
+# Micro-batcher: single-image requests queue up here and a background
+# task coalesces them into one ocr.predict([img, ...]) call, amortizing
+# per-call kernel-launch and Python/C++ boundary overhead.
+OCR_BATCH_SIZE = int(os.environ.get("OCR_BATCH_SIZE", "16"))
+BATCH_QUEUE: asyncio.Queue = asyncio.Queue()
+
+
+async def _batch_worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        items = [await BATCH_QUEUE.get()]
+        while len(items) < OCR_BATCH_SIZE:
+            try:
+                items.append(BATCH_QUEUE.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        try:
+            async with OCR_SEM:
+                results = await loop.run_in_executor(
+                    POOL, _predict_with_retry, [img for img, _ in items]
+                )
+            for (_, fut), result in zip(items, results):
+                if not fut.done():
+                    fut.set_result(result)
+        except Exception as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+@app.on_event("startup")
+async def start_batch_worker():
+    # Model load happens here, once per serving process - see _init_ocr
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(POOL, _init_ocr)
+
+    asyncio.create_task(_batch_worker())
+
+    # Warm up the predictor so the first real request doesn't pay cuDNN
+    # autotune / weight-upload costs. Use the batcher's target batch size
+    # to prime the graph for the shapes it will actually see.
+    if ocr is not None:
+        try:
+            dummy = [np.zeros((640, 640, 3), dtype=np.uint8)] * OCR_BATCH_SIZE
+            for _ in range(2):
+                await loop.run_in_executor(POOL, ocr.predict, dummy)
+            print("Paddle predictor warmed up.")
+        except Exception as e:
+            print(f"Warmup failed (continuing anyway): {e}")
 
 # Setup CORS
 app.add_middleware(
@@ -23,19 +236,83 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize PaddleOCR
-print("Initializing PaddleOCR (v3.4.0)...")
-try:
-    ocr = PaddleOCR(use_textline_orientation=True, lang='en')
-    print("PaddleOCR initialized successfully.")
-except Exception as e:
-    print(f"Init with textline_orientation failed: {e}, trying basic...")
+# Pick the device explicitly - Paddle silently falls back to CPU when
+# the GPU build/flags are missing, so log what we actually got.
+import paddle
+
+OCR_DEVICE = os.environ.get(
+    "OCR_DEVICE",
+    "gpu:0"
+    if paddle.device.is_compiled_with_cuda() and paddle.device.cuda.device_count() > 0
+    else "cpu",
+)
+
+# Quantized models (PaddleSlim PTQ, produced offline) roughly double
+# throughput: int8 recognition on VNNI/tensor cores, fp16 detection.
+# Point these at the quantized model dirs; their dtype comes from the
+# model files themselves, not from the precision flag.
+OCR_DET_MODEL_DIR = os.environ.get("OCR_DET_MODEL_DIR")
+OCR_REC_MODEL_DIR = os.environ.get("OCR_REC_MODEL_DIR")
+# precision only selects the TensorRT run mode and is ignored on plain
+# GPU/CPU execution, so fp16 is opt-in and implies use_tensorrt below.
+OCR_PRECISION = os.environ.get("OCR_PRECISION", "fp32")
+
+# Fail fast on bad values - paddleocr raises on them too, but that lands
+# in the init fallback below and silently serves stock-model defaults.
+if OCR_PRECISION not in ("fp32", "fp16"):
+    raise ValueError(
+        f"OCR_PRECISION must be fp32 or fp16, got {OCR_PRECISION!r}"
+    )
+if not (OCR_DEVICE == "cpu" or OCR_DEVICE.split(":")[0] in ("gpu", "xpu", "npu")):
+    raise ValueError(f"Unrecognized OCR_DEVICE {OCR_DEVICE!r}")
+
+# Longest image side fed to the detector. Accuracy tracks text height in
+# pixels rather than raw resolution, so clamping keeps worst-case
+# latency predictable on full-resolution scans.
+OCR_MAX_SIDE = int(os.environ.get("OCR_MAX_SIDE", "1536"))
+
+# DPI for rasterizing PDF pages; 200 keeps text tall enough to read
+# while staying inside the OCR_MAX_SIDE clamp for most page sizes.
+OCR_PDF_DPI = int(os.environ.get("OCR_PDF_DPI", "200"))
+
+# The predictor is built in the startup hook rather than at import time
+# so a multi-worker launch doesn't also load a full model (GPU memory
+# included) into the supervisor process, which never serves requests.
+ocr = None
+
+
+def _init_ocr():
+    global ocr
+    print(f"Initializing PaddleOCR (v3.4.0) on {OCR_DEVICE}...")
     try:
-        ocr = PaddleOCR(lang='en')
-        print("PaddleOCR initialized (basic mode).")
-    except Exception as e2:
-        print(f"PaddleOCR init failed completely: {e2}")
-        ocr = None
+        ocr = PaddleOCR(
+            use_textline_orientation=True,
+            lang='en',
+            device=OCR_DEVICE,
+            precision=OCR_PRECISION,
+            use_tensorrt=OCR_PRECISION == "fp16",
+            text_detection_model_dir=OCR_DET_MODEL_DIR,
+            text_recognition_model_dir=OCR_REC_MODEL_DIR,
+            enable_mkldnn=True,
+            cpu_threads=max(1, (os.cpu_count() or 2) // 2),
+            # Recognition/orientation batch the text crops of a page internally
+            text_recognition_batch_size=32,
+            textline_orientation_batch_size=32,
+            # Cap the *longest* side inside the detector too. The pipeline
+            # default limit_type is "min", which would upscale anything whose
+            # short side is under the limit - the opposite of clamping.
+            text_det_limit_side_len=OCR_MAX_SIDE,
+            text_det_limit_type="max",
+        )
+        print(f"PaddleOCR initialized successfully (device={OCR_DEVICE}).")
+    except Exception as e:
+        print(f"Init with textline_orientation failed: {e}, trying basic...")
+        try:
+            ocr = PaddleOCR(lang='en')
+            print("PaddleOCR initialized (basic mode).")
+        except Exception as e2:
+            print(f"PaddleOCR init failed completely: {e2}")
+            ocr = None
 
 
 @app.get("/health")
@@ -44,85 +321,114 @@ async def health():
 
 
 @app.post("/ocr")
-async def perform_ocr(file: UploadFile = File(...)):
+async def perform_ocr(file: UploadFile = File(...), stream: bool = False):
     if ocr is None:
         raise HTTPException(status_code=503, detail="PaddleOCR failed to initialize")
 
-    temp_path = None
     try:
         contents = await file.read()
         filename = (file.filename or "unknown.pdf").lower()
+        loop = asyncio.get_running_loop()
 
         if filename.endswith('.pdf'):
-            temp_path = f"temp_{file.filename}"
-            with open(temp_path, "wb") as f:
-                f.write(contents)
-            input_data = temp_path
+            if stream:
+                # Render and OCR page by page so memory stays bounded on
+                # large documents instead of rasterizing everything first.
+                return StreamingResponse(
+                    _stream_pages(contents), media_type="application/x-ndjson"
+                )
+            # Render pages in-process with PyMuPDF - no temp file, no
+            # disk round-trip, and every page can join the batcher.
+            images = await loop.run_in_executor(POOL, _render_pdf, contents)
         else:
-            image = Image.open(io.BytesIO(contents)).convert('RGB')
-            img_array = np.array(image)
-            img_array = img_array[:, :, ::-1].copy()  # RGB -> BGR
-            input_data = img_array
+            # Decode straight to a contiguous BGR ndarray (what PaddleOCR expects).
+            # np.frombuffer is zero-copy over the upload bytes.
+            buf = np.frombuffer(contents, dtype=np.uint8)
+            img_array = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+            if img_array is None:
+                # Fallback for formats cv2 can't decode (e.g. multi-page TIFF)
+                image = Image.open(io.BytesIO(contents))
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                # Fused SIMD channel swap; the strided ::-1 copy was ~2-3x slower
+                rgb = np.asarray(image)
+                img_array = cv2.cvtColor(
+                    rgb, cv2.COLOR_RGB2BGR, dst=_get_buf(rgb.shape)
+                )
 
-        # Use predict() - the v3.4.0 API (ocr() is deprecated and broken)
-        prediction = ocr.predict(input_data)
+            # Clamp oversized scans before inference; uniform sizes also
+            # batch better than a mix of full-resolution pages.
+            images = [_downscale(img_array)]
+
+        # Use predict() - the v3.4.0 API (ocr() is deprecated and broken).
+        # Every page/image goes through the micro-batcher, so a whole PDF
+        # coalesces into batched predict calls.
+        futs = []
+        for img in images:
+            fut = loop.create_future()
+            await BATCH_QUEUE.put((img, fut))
+            futs.append(fut)
+
+        if stream:
+            # NDJSON for the image branch: a single line per decoded page
+            async def gen():
+                try:
+                    for i, fut in enumerate(futs):
+                        page = _format_page(await fut, i)
+                        yield orjson.dumps(
+                            page, option=orjson.OPT_SERIALIZE_NUMPY
+                        ) + b"\n"
+                except OCRBusyError as e:
+                    yield orjson.dumps({"error": f"OCR engine overloaded: {e}"}) + b"\n"
+                except Exception as e:
+                    print(f"OCR Error (stream): {e}")
+                    traceback.print_exc()
+                    yield orjson.dumps({"error": str(e)}) + b"\n"
+
+            return StreamingResponse(gen(), media_type="application/x-ndjson")
 
-        extracted_text = []
-        raw_results = []
         pages = []
+        raw_results = []
+        text_parts = []
+        line_count = 0
+        for fut in futs:
+            page = _format_page(await fut, len(pages))
+            raw_results.extend(page.pop("results"))
+            text_parts.append(page["text"])
+            line_count += page["line_count"]
+            pages.append(page)
 
-        for item in prediction:
-            # item is an OCRResult with .json property
-            res = item.json.get('res', item.json)
-
-            rec_texts = res.get('rec_texts', [])
-            rec_scores = res.get('rec_scores', [])
-            dt_polys = res.get('dt_polys', [])
-            page_index = res.get('page_index', None)
-            page_num = (page_index if page_index is not None else len(pages)) + 1
-
-            page_lines = []
-            for i, text in enumerate(rec_texts):
-                text_str = str(text)
-                confidence = float(rec_scores[i]) if i < len(rec_scores) else 0.0
-                box = dt_polys[i] if i < len(dt_polys) else []
-                # Convert numpy arrays to plain lists for JSON serialization
-                if hasattr(box, 'tolist'):
-                    box = box.tolist()
-
-                extracted_text.append(text_str)
-                page_lines.append(text_str)
-                raw_results.append({
-                    "text": text_str,
-                    "confidence": confidence,
-                    "box": box,
-                    "page": page_num
-                })
-
-            pages.append({
-                "page_number": page_num,
-                "text": "\n".join(page_lines),
-                "line_count": len(page_lines)
-            })
-
-        print(f"OCR complete: {len(pages)} pages, {len(extracted_text)} text lines")
+        print(f"OCR complete: {len(pages)} pages, {line_count} text lines")
 
         return {
-            "text": "\n".join(extracted_text),
+            "text": "\n".join(p for p in text_parts if p),
             "results": raw_results,
             "pages": pages,
             "page_count": len(pages),
             "engine": "paddle"
         }
 
+    except OCRBusyError as e:
+        # Give retrying clients a backoff signal instead of a bare 500
+        raise HTTPException(
+            status_code=429,
+            detail=f"OCR engine overloaded: {e}",
+            headers={"Retry-After": "2"},
+        )
     except Exception as e:
         print(f"OCR Error: {e}")
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            os.remove(temp_path)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker process loads its own Paddle predictor (one CUDA context
+    # per process), so N workers give ~Nx throughput until the GPU
+    # saturates. Also runnable under gunicorn:
+    #   gunicorn -k uvicorn.workers.UvicornWorker -w 4 ocr_backend:app
+    # Pin workers to devices with CUDA_VISIBLE_DEVICES in their env.
+    workers = int(os.environ.get("OCR_WORKERS", "1"))
+    if workers > 1:
+        uvicorn.run("ocr_backend:app", host="0.0.0.0", port=8000, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8000)